@@ -1,11 +1,16 @@
 import logging
 import os
+import queue
+import re
 import subprocess
-from typing import List
-from PIL import Image
+import threading
+from typing import List, Optional, Set, Tuple
+from PIL import ExifTags, Image, ImageOps
 from bs4 import BeautifulSoup
 import unicodedata
+from pathlib import Path
 import argparse
+import hashlib
 
 logging.basicConfig(
     level=logging.INFO,
@@ -15,8 +20,29 @@ logging.basicConfig(
 
 MAX_WIDTH = 1500
 MAX_HEIGHT = 2000
+JPEG_QUALITY = 85
+REDUCING_GAP = 3.0  # per Pillow docs, >= 3 is indistinguishable from plain Lanczos
+CONVERTED_MODES = frozenset({'P', 'PA', 'LA', 'CMYK', 'YCbCr'})  # other modes, e.g. 16-bit grayscale, are kept as is
+ROTATED_ORIENTATIONS = frozenset({5, 6, 7, 8})  # EXIF orientations that swap width and height
+
+INDEX_PREFIX_RE = re.compile(r'(?:^|/)(\d+)_')  # "12_name.jpg" or "photos_resized/12_name.jpg"
+PHOTO_GRID_SCAN_RE = re.compile(
+    rb'<!--.*?-->'
+    rb'|<(?P<raw>script|style|template|textarea)\b.*?</(?P=raw)\s*>'
+    rb'|(?P<grid><div\b[^>]*\bclass\s*=\s*(?P<q>["\'])[^"\']*(?<![\w-])photo-grid(?![\w-])[^"\']*(?P=q)[^>]*>)',
+    re.IGNORECASE | re.DOTALL
+)  # raw opening tags of photo-grid divs, skipping comments and blocks the browser never renders as markup
+LINE_INDENT_RE = re.compile(rb'[ \t]*\r?\n[ \t]*')
+IMAGE_EXTENSION_RE = re.compile(r'\.(?:jpe?g|png)\Z', re.IGNORECASE)  # case-insensitive, no lower() copies
+
+READER_THREADS = 4  # files read and decoded concurrently
+QUEUE_SIZE = 8  # max decoded/resized images waiting between pipeline stages
+POISON_PILL = None  # tells a pipeline stage to shut down
 
 HTML_FILE_RELATIVE_PATH = 'index.html'  # for now not needed as an script arg
+NEXT_INDEX_CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'photo-uploader'
+)  # one small file per output folder, kept out of the portfolio repo
 
 
 def normalize_filename(filename: str) -> str:
@@ -26,65 +52,216 @@ def normalize_filename(filename: str) -> str:
     return unicodedata.normalize('NFC', filename)
 
 
-def resize_image(input_path: str, output_path: str) -> bool:
+def image_index(path: str) -> int:
     """
-    Resize an image preserving aspect ratio to fit within MAX_WIDTH and MAX_HEIGHT.
-    Save the resized image to output_path.
-    Returns True if successful, False otherwise.
+    Extract the numeric index prefix from an image filename or src path.
+    Returns -1 if there is no index prefix.
     """
-    try:
-        with Image.open(input_path) as img:
-            original_size = img.size
-            width, height = original_size
+    match = INDEX_PREFIX_RE.search(path)
+    return int(match.group(1)) if match else -1
+
+
+def is_image_filename(filename: str) -> bool:
+    """
+    Check if a filename is a visible .jpg, .jpeg or .png image.
+    """
+    if filename.startswith('.'):  # ignore hidden files
+        return False
+    return IMAGE_EXTENSION_RE.search(filename) is not None
 
-            scale_w = MAX_WIDTH / width if width > MAX_WIDTH else 1
-            scale_h = MAX_HEIGHT / height if height > MAX_HEIGHT else 1
-            scale = min(scale_w, scale_h)
 
-            if scale < 1:
-                new_size = (int(width * scale), int(height * scale))
-                img = img.resize(new_size, Image.Resampling.LANCZOS)
+def load_image(input_path: str) -> Tuple[Image.Image, Tuple[int, int]]:
+    """
+    Open and fully decode an image, so the file handle is released before
+    the image is handed over to the resize stage. Returns the image and the
+    size stored in the file, for logging.
+    JPEGs are decoded at a reduced scale, never smaller than twice the target size,
+    and the EXIF orientation is applied on the decoded pixels.
+    """
+    with Image.open(input_path) as img:
+        original_size = img.size
+        if img.format == 'JPEG':
+            width, height = original_size
+            if img.getexif().get(ExifTags.Base.Orientation) in ROTATED_ORIENTATIONS:
+                # Pixels are stored sideways: fit the displayed size, then swap back
+                target_h, target_w = target_size(height, width)
             else:
-                new_size = original_size
+                target_w, target_h = target_size(width, height)
+            # libjpeg scales down during the IDCT, so Lanczos has far fewer pixels to process
+            img.draft('RGB', (target_w * 2, target_h * 2))
+        img.load()
+        # The saved image carries no EXIF, so the orientation has to be baked into the pixels
+        ImageOps.exif_transpose(img, in_place=True)
+        if img.mode in CONVERTED_MODES:
+            # Palette images would otherwise be resized with NEAREST, CMYK carries an extra band
+            img = img.convert('RGBA' if img.has_transparency_data else 'RGB')
+        return img, original_size
+
+
+def target_size(width: int, height: int) -> Tuple[int, int]:
+    """
+    Compute the size that fits (width, height) within MAX_WIDTH and MAX_HEIGHT,
+    preserving aspect ratio.
+    """
+    scale_w = MAX_WIDTH / width if width > MAX_WIDTH else 1
+    scale_h = MAX_HEIGHT / height if height > MAX_HEIGHT else 1
+    scale = min(scale_w, scale_h)
 
-            img.save(output_path)
-            logging.info(f"Resized '{input_path}' from {original_size} to {new_size}")
-            return True
-    except Exception as e:
-        logging.error(f"Error resizing image {input_path}: {e}")
-        return False
+    if scale < 1:
+        return int(width * scale), int(height * scale)
+    return width, height
 
 
-def get_next_index(output_folder: str) -> int:
+def fit_image(img: Image.Image) -> Image.Image:
     """
-    Scan the output folder and find the next available numeric index
-    based on the existing files with prefix numbers.
+    Resize an image preserving aspect ratio to fit within MAX_WIDTH and MAX_HEIGHT.
+    Returns the image untouched if it already fits.
     """
-    valid_exts = ('.jpg', '.jpeg', '.png')
-    files = os.listdir(output_folder)
-    indices = []
-    for f in files:
-        if f.startswith('.'):  # ignore hidden files
-            continue
-        if not f.lower().endswith(valid_exts):  # ignore non-image files
+    new_size = target_size(*img.size)
+    if new_size != img.size:
+        # Box-reduce by an integer factor first, Lanczos then only runs on the last <3x step
+        return img.resize(new_size, Image.Resampling.LANCZOS, reducing_gap=REDUCING_GAP)
+    return img
+
+
+def save_image(img: Image.Image, output_path: str) -> None:
+    """
+    Save an image to output_path, using fixed encoder settings for JPEGs.
+    """
+    if output_path.lower().endswith(('.jpg', '.jpeg')):
+        if img.mode == 'RGBA':
+            img = img.convert('RGB')
+        # Baseline encode: no extra Huffman optimization pass and no progressive scans
+        img.save(output_path, 'JPEG', quality=JPEG_QUALITY, subsampling='4:2:0', optimize=False, progressive=False)
+    else:
+        img.save(output_path)
+
+
+def read_worker(tasks: List[Tuple[str, str, str]], read_q: queue.Queue) -> None:
+    """
+    Reader stage: decode the given input images and feed them to the resize workers.
+    """
+    for task in tasks:
+        input_path = task[0]
+        try:
+            read_q.put((task, *load_image(input_path)))
+        except Exception as e:
+            logging.error(f"Error reading image {input_path}: {e}")
+
+
+def resize_worker(read_q: queue.Queue, write_q: queue.Queue) -> None:
+    """
+    Resize stage: shrink decoded images until a poison pill is received.
+    """
+    while True:
+        item = read_q.get()
+        if item is POISON_PILL:
+            return
+        task, img, original_size = item
+        input_path = task[0]
+        try:
+            resized = fit_image(img)
+            logging.info(f"Resized '{input_path}' from {original_size} to {resized.size}")
+            write_q.put((task, resized))
+        except Exception as e:
+            logging.error(f"Error resizing image {input_path}: {e}")
+
+
+def write_worker(write_q: queue.Queue, written: Set[str]) -> None:
+    """
+    Writer stage: encode and save resized images, recording the saved filenames.
+    """
+    while True:
+        item = write_q.get()
+        if item is POISON_PILL:
+            return
+        (_, output_path, output_fname), img = item
+        try:
+            save_image(img, output_path)
+        except Exception as e:
+            logging.error(f"Error saving image {output_path}: {e}")
             continue
-        if '_' not in f:
-            raise ValueError(f"File '{f}' in output folder does not have an index prefix.")
-        prefix = f.split('_')[0]
-        if not prefix.isdigit():
-            raise ValueError(f"File '{f}' in output folder has invalid index prefix.")
-        indices.append(int(prefix))
-    return max(indices) + 1 if indices else 1
+        written.add(output_fname)
+
+
+def next_index_cache_path(output_folder: str) -> str:
+    """
+    Path of the next index cache for output_folder. It lives in the user cache
+    directory, outside the portfolio repo, so it never gets committed.
+    """
+    folder_key = hashlib.sha1(os.path.realpath(output_folder).encode('utf-8')).hexdigest()
+    return os.path.join(NEXT_INDEX_CACHE_DIR, folder_key)
 
 
-def process_images(input_folder: str, output_folder: str) -> List[str]:
+def read_cached_next_index(output_folder: str) -> Optional[int]:
+    """
+    Read the cached next index of the output folder.
+    Returns None if there is no cache or the folder changed since it was written.
+    """
+    try:
+        with open(next_index_cache_path(output_folder), encoding='utf-8') as f:
+            next_index, mtime = (int(value) for value in f.read().split())
+        if os.stat(output_folder).st_mtime_ns != mtime:
+            return None
+    except (OSError, ValueError):
+        return None
+    return next_index
+
+
+def save_next_index(output_folder: str, next_index: int) -> None:
+    """
+    Cache next_index for the output folder, stamped with the folder mtime
+    so that any later change to the folder invalidates it.
+    """
+    path = next_index_cache_path(output_folder)
+    try:
+        mtime = os.stat(output_folder).st_mtime_ns
+        os.makedirs(NEXT_INDEX_CACHE_DIR, exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(f"{next_index} {mtime}\n")
+    except OSError as e:
+        logging.warning(f"Could not cache next index in '{path}': {e}")
+
+
+def get_next_index(output_folder: str) -> int:
+    """
+    Find the next available numeric index for the output folder, from the cache
+    if it is still valid, otherwise by scanning the existing files with prefix numbers.
+    """
+    cached = read_cached_next_index(output_folder)
+    if cached is not None:
+        return cached
+
+    max_index = 0
+    with os.scandir(output_folder) as entries:
+        for entry in entries:
+            f = entry.name
+            if not is_image_filename(f):  # ignore hidden and non-image files
+                continue
+            prefix, sep, _ = f.partition('_')
+            if not sep:
+                raise ValueError(f"File '{f}' in output folder does not have an index prefix.")
+            if not prefix.isdigit():
+                raise ValueError(f"File '{f}' in output folder has invalid index prefix.")
+            index = int(prefix)
+            if index > max_index:
+                max_index = index
+    return max_index + 1
+
+
+def process_images(input_folder: str, output_folder: str, num_workers: Optional[int] = None) -> List[str]:
     """
     Process all images from input_folder:
     resize them, save to output_folder with numeric prefix,
     delete original, and return list of new filenames.
+    Resizing runs on num_workers threads, one per CPU by default.
     """
+    if num_workers is not None and num_workers < 1:
+        raise ValueError(f"num_workers must be at least 1, got {num_workers}.")
+
     logging.info("Processing and resizing images...")
-    input_files = [f for f in os.listdir(input_folder) if f.lower().endswith(('.jpg', '.jpeg', '.png'))]
+    with os.scandir(input_folder) as entries:
+        input_files = [(entry.name, entry.path) for entry in entries if is_image_filename(entry.name)]
     if not input_files:
         logging.info("No images found in input folder.")
         return []
@@ -95,40 +272,75 @@ def process_images(input_folder: str, output_folder: str) -> List[str]:
         logging.error(f"Error: {e}")
         return []
 
+    out_prefix = os.path.join(output_folder, '')  # joined once, then plain concatenation
+    tasks = []
+    for offset, (fname, input_path) in enumerate(input_files):
+        output_fname = f"{start_index + offset}_{normalize_filename(fname)}"
+        tasks.append((input_path, out_prefix + output_fname, output_fname))
+
+    # Decoding, resizing and encoding overlap; Pillow releases the GIL in all three
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    read_q = queue.Queue(maxsize=QUEUE_SIZE)
+    write_q = queue.Queue(maxsize=QUEUE_SIZE)
+    written = set()
+
+    # Several readers keep multiple files in flight, hiding latency on slow or network storage
+    readers = [threading.Thread(target=read_worker, args=(tasks[i::READER_THREADS], read_q))
+               for i in range(READER_THREADS)]
+    resizers = [threading.Thread(target=resize_worker, args=(read_q, write_q)) for _ in range(num_workers)]
+    writer = threading.Thread(target=write_worker, args=(write_q, written))
+    for thread in (*readers, *resizers, writer):
+        thread.start()
+
+    for thread in readers:
+        thread.join()
+    for _ in resizers:
+        read_q.put(POISON_PILL)
+    for thread in resizers:
+        thread.join()
+    write_q.put(POISON_PILL)
+    writer.join()
+
+    # Originals are deleted in one go once the pipeline is done, only for saved images
     new_files = []
-    idx = start_index
-
-    for fname in input_files:
-        input_path = os.path.join(input_folder, fname)
-        normalized_name = normalize_filename(fname)
-        output_fname = f"{idx}_{normalized_name}"
-        output_path = os.path.join(output_folder, output_fname)
-
-        success = resize_image(input_path, output_path)
-        if success:
-            try:
-                os.remove(input_path)
-            except Exception as e:
-                logging.warning(f"Could not delete original image '{input_path}': {e}")
-            new_files.append(output_fname)
-            idx += 1
+    for input_path, _, output_fname in tasks:
+        if output_fname not in written:
+            continue
+        try:
+            os.unlink(input_path)
+        except Exception as e:
+            logging.warning(f"Could not delete original image '{input_path}': {e}")
+        new_files.append(output_fname)
 
+    if new_files:
+        save_next_index(output_folder, start_index + len(tasks))
     return new_files
 
 
 def update_html_only_photogrid(html_file: str, output_folder: str, new_images: List[str]) -> None:
     """
     Update the photo-grid div in the given HTML file by adding new_images
-    at the top and reordering all images descending by their numeric prefix.
+    at the top, keeping the grid descending by numeric prefix.
     """
     logging.info("Updating HTML photo grid...")
-    with open(html_file, 'r', encoding='utf-8') as f:
-        soup = BeautifulSoup(f, 'html.parser')
+    # Read and write the whole file in one call, the parser decodes the raw bytes itself
+    html = Path(html_file).read_bytes()
+    soup = BeautifulSoup(html, 'lxml', from_encoding='utf-8')
 
-    photo_grid = soup.find('div', class_='photo-grid')
-    if photo_grid is None or not hasattr(photo_grid, 'find_all'):
+    photo_grids = [div for div in soup.find_all('div', class_='photo-grid') if div.find_parent('template') is None]
+    if not photo_grids:
         logging.error("Error: 'photo-grid' div not found in HTML or is not a valid tag.")
         return
+    photo_grid = photo_grids[0]
+
+    # New tags are spliced into the raw bytes, so the opening tag found there has to be the grid soup found
+    grid_opens = [m for m in PHOTO_GRID_SCAN_RE.finditer(html) if m.group('grid')]
+    if len(grid_opens) != len(photo_grids) or \
+            BeautifulSoup(grid_opens[0].group('grid'), 'lxml').div.attrs != photo_grid.attrs:
+        logging.error("Error: could not locate the 'photo-grid' div in the raw HTML, file left unchanged.")
+        return
+    grid_open = grid_opens[0]
 
     from bs4.element import Tag
     current_imgs = {os.path.basename(str(img.get('src', ''))) for img in photo_grid.find_all('img') if isinstance(img, Tag) and img.get('src')}
@@ -138,31 +350,22 @@ def update_html_only_photogrid(html_file: str, output_folder: str, new_images: L
         logging.info("No new images to add to HTML.")
         return
 
-    new_images_sorted = sorted(new_images, key=lambda f: int(f.split('_')[0]))
+    new_images_sorted = sorted(new_images, key=image_index)
 
-    # Insert new images at the beginning
+    grid_start = grid_open.end('grid')
+    # Reuse the indentation of the grid's first line, if there is one
+    leading = LINE_INDENT_RE.match(html, grid_start)
+    separator = leading.group().decode('utf-8') if leading else "\n  "
+
+    # The grid is already descending by index and new images always get the highest
+    # indices, so putting them first in descending order keeps it sorted without a full reorder
+    new_tags = []
     for fname in reversed(new_images_sorted):
         img_tag = soup.new_tag("img", src=f"photos_resized/{fname}", alt=fname.rsplit('.', 1)[0], loading="lazy")
-        if hasattr(photo_grid, "insert"):
-            photo_grid.insert(0, img_tag)
-            photo_grid.insert(1, soup.new_string("\n  "))
-
-    # Reorder all imgs descending by index
-    all_imgs = photo_grid.find_all('img')
-    def img_index(img) -> int:
-        try:
-            return int(os.path.basename(img['src']).split('_')[0])
-        except Exception:
-            return -1
-    sorted_imgs = sorted(all_imgs, key=img_index, reverse=True)
-
-    photo_grid.clear()
-    for img in sorted_imgs:
-        photo_grid.append(img)
-        photo_grid.append(soup.new_string("\n  "))
+        new_tags.append(f"{separator}{img_tag}")
 
-    with open(html_file, 'w', encoding='utf-8') as f:
-        f.write(soup.prettify())
+    # Splice the new tags in right after the opening div, the rest of the file is written back byte for byte
+    Path(html_file).write_bytes(html[:grid_start] + ''.join(new_tags).encode('utf-8') + html[grid_start:])
 
     logging.info(f"🌟 HTML updated successfully: added {len(new_images)} new image(s).")
 
@@ -188,16 +391,17 @@ def git_commit_and_push(num_new_images: int, commit_message: str = None) -> None
         return
 
     try:
-        status = subprocess.run(["git", "status", "--porcelain"], capture_output=True, text=True)
-        if not status.stdout.strip():
+        subprocess.run(["git", "add", "."], check=True)
+        # Checking the staged tree also catches new untracked images
+        staged = subprocess.run(["git", "diff", "--cached", "--quiet"])
+        if staged.returncode == 0:
             logging.info("No changes detected in git. Nothing to commit or push.")
             return
+        if staged.returncode != 1:
+            raise subprocess.CalledProcessError(staged.returncode, staged.args)
 
-        subprocess.run(["git", "add", "."], check=True)
         subprocess.run(["git", "commit", "-m", commit_message], check=True)
-
-        branch = subprocess.run(["git", "rev-parse", "--abbrev-ref", "HEAD"], capture_output=True, text=True).stdout.strip()
-        subprocess.run(["git", "push", "origin", branch], check=True)
+        subprocess.run(["git", "push", "origin", "HEAD"], check=True)
 
         logging.info("✅ Git push successful.")
     except subprocess.CalledProcessError as e:
@@ -206,15 +410,26 @@ def git_commit_and_push(num_new_images: int, commit_message: str = None) -> None
         logging.error(f"Unexpected error during git operations: {e}")
 
 
+def positive_int(value: str) -> int:
+    """
+    Argparse type for options that need an integer >= 1.
+    """
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
+
 def main() -> None:
     parser = argparse.ArgumentParser(description="Resize images, update HTML, and optionally push changes to git.")
     parser.add_argument("--input", required=True, help="Path to the folder with new images")
     parser.add_argument("--output", required=True, help="Path to the folder where resized images will be stored")
+    parser.add_argument("--workers", type=positive_int, default=None, help="Number of resize threads (default: one per CPU)")
     args = parser.parse_args()
     html_file = HTML_FILE_RELATIVE_PATH
 
     logging.info("Script started!")
-    new_images = process_images(args.input, args.output)
+    new_images = process_images(args.input, args.output, args.workers)
     if new_images:
         update_html_only_photogrid(html_file, args.output, new_images)
         logging.info("📂 Process Complete!")